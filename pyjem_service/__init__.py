@@ -1,64 +1,72 @@
 from pigeon import Pigeon
 import time
 import logging
+import bisect
+import queue
 from PyJEM import TEM3
 from math import pi
-from threading import RLock
+from threading import Event, Lock, Thread
+
+_DEG_PER_RAD = 180.0 / pi
+_RAD_PER_DEG = pi / 180.0
 
 
 class PyJEMService:
     BEAM_MOVE_TIME = 0.2
+    SCOPE_CACHE_TIME = 10
+    MAG_MODE_RETRIES = 3
+    MAG_MODE_BACKOFF = 0.05
     MAG_MODES = {
         "MAG1": 0,
         "MAG2": 1,
         "LM": 2,
     }
-    MAG_TABLE = {
-        2000: 0,
-        2500: 1,
-        3000: 2,
-        4000: 3,
-        5000: 4,
-        6000: 5,
-        8000: 6,
-        10000: 7,
-        12000: 8,
-        15000: 9,
-        20000: 10,
-        25000: 11,
-        30000: 12,
-        40000: 13,
-        50000: 14,
-        60000: 15,
-        80000: 16,
-        100000: 17,
-        120000: 18,
-        150000: 19,
-        200000: 20,
-        250000: 21,
-        300000: 22,
-        500000: 23,
-        600000: 24,
-        800000: 25,
-        1000000: 26,
-        1200000: 27,
-    }
-    LOWMAG_TABLE = {
-        50: 0,
-        100: 1,
-        120: 2,
-        150: 3,
-        200: 4,
-        250: 5,
-        300: 6,
-        400: 7,
-        500: 8,
-        600: 9,
-        800: 10,
-        1000: 11,
-        1200: 12,
-        1500: 13,
-    }
+    MAG_VALUES = (
+        2000,
+        2500,
+        3000,
+        4000,
+        5000,
+        6000,
+        8000,
+        10000,
+        12000,
+        15000,
+        20000,
+        25000,
+        30000,
+        40000,
+        50000,
+        60000,
+        80000,
+        100000,
+        120000,
+        150000,
+        200000,
+        250000,
+        300000,
+        500000,
+        600000,
+        800000,
+        1000000,
+        1200000,
+    )
+    LOWMAG_VALUES = (
+        50,
+        100,
+        120,
+        150,
+        200,
+        250,
+        300,
+        400,
+        500,
+        600,
+        800,
+        1000,
+        1200,
+        1500,
+    )
 
     def __init__(
         self,
@@ -68,14 +76,15 @@ class PyJEMService:
         password: str = None,
         logger: logging.Logger = None,
         trans_tol: int = 125,
-        rot_tol: float = 0.2 * pi / 180,
+        rot_tol: float = 0.2 * _RAD_PER_DEG,
     ):
         self._logger = logger if logger is not None else logging.getLogger(__name__)
 
         self.trans_tol = trans_tol
         self.rot_tol = rot_tol
 
-        self.scope_lock = RLock()
+        self.scope_lock = Lock()
+        self._wake = Event()
 
         with self.scope_lock:
             assert TEM3.connect()
@@ -92,145 +101,246 @@ class PyJEMService:
 
         with self.scope_lock:
             self.x, self.y, self.z, tx, ty = self.stage.GetPos()
-        self.tx = tx * pi / 180
-        self.ty = ty * pi / 180
+        self.tx = tx * _RAD_PER_DEG
+        self.ty = ty * _RAD_PER_DEG
+
+        self.last_stage_status = time.monotonic()
+        self.last_scope_status = time.monotonic()
+        self.last_aperture_status = time.monotonic()
+
+        self._scope_cache = {}
+        self._scope_cache_time = time.monotonic()
 
-        self.last_stage_status = time.time()
-        self.last_scope_status = time.time()
+        self._cmd_q = queue.SimpleQueue()
+        self._pending_motion = None
+        self._pending_lock = Lock()
+        Thread(target=self._cmd_worker, daemon=True).start()
 
-        self.connection = Pigeon("pyjem_service", host=host, port=port, spawn_threads=True, connection_timeout=None)
+        self.connection = Pigeon("pyjem_service", host=host, port=port, connection_timeout=None)
         self.connection.connect(username=username, password=password)
         self.connection.subscribe("stage.motion.command", self.motion_callback)
         self.connection.subscribe("stage.rotation.command", self.rotation_callback)
         self.connection.subscribe("scope.command", self.scope_callback)
 
     def motion_callback(self, msg):
+        # Merge into the pending motion while it is still the last queued command, so only the
+        # latest target is sent without reordering it past other commands.
+        with self._pending_lock:
+            if self._pending_motion is None:
+                self._pending_motion = {}
+                self._cmd_q.put((self._apply_motion, self._pending_motion))
+            for axis in ("x", "y", "z"):
+                if (value := getattr(msg, axis)) is not None:
+                    self._pending_motion[axis] = value
+
+    def rotation_callback(self, msg):
+        self._enqueue(self._apply_rotation, msg)
+
+    def scope_callback(self, msg):
+        self._enqueue(self._apply_scope, msg)
+
+    def _enqueue(self, apply, msg):
+        with self._pending_lock:
+            self._pending_motion = None
+            self._cmd_q.put((apply, msg))
+
+    def _cmd_worker(self):
+        while True:
+            apply, msg = self._cmd_q.get()
+            try:
+                apply(msg)
+            except Exception:
+                self._logger.warning("Error applying command:", exc_info=True)
+            self._wake.set()
+
+    def _apply_motion(self, motion):
+        with self._pending_lock:
+            if self._pending_motion is motion:
+                self._pending_motion = None
         with self.scope_lock:
             self.was_in_motion = True
-            if msg.x is not None:
-                self.stage.SetX(msg.x)
-                self.x = msg.x
-            if msg.y is not None:
-                self.stage.SetY(msg.y)
-                self.y = msg.y
-            if msg.z is not None:
-                self.stage.SetZ(msg.z)
-                self.z = msg.z
+            if "x" in motion:
+                self.stage.SetX(motion["x"])
+                self.x = motion["x"]
+            if "y" in motion:
+                self.stage.SetY(motion["y"])
+                self.y = motion["y"]
+            if "z" in motion:
+                self.stage.SetZ(motion["z"])
+                self.z = motion["z"]
 
-    def rotation_callback(self, msg):
+    def _apply_rotation(self, msg):
         with self.scope_lock:
             self.was_in_motion = True
             if msg.angle_x is not None:
-                self.stage.SetTiltXAngle(msg.angle_x * 180 / pi)
+                self.stage.SetTiltXAngle(msg.angle_x * _DEG_PER_RAD)
                 self.tx = msg.angle_x
             if msg.angle_y is not None:
-                self.stage.SetTiltYAngle(msg.angle_y * 180 / pi)
+                self.stage.SetTiltYAngle(msg.angle_y * _DEG_PER_RAD)
                 self.ty = msg.angle_y
 
-    def scope_callback(self, msg):
+    def _apply_scope(self, msg):
+        stale = [
+            key
+            for key, value in (
+                ("function_mode", msg.mag),
+                ("mag", msg.mag),
+                ("spot_size", msg.spot_size),
+                ("beam_offset", msg.beam_offset),
+                ("beam_blank", msg.screen),
+            )
+            if value is not None
+        ]
         with self.scope_lock:
+            for key in stale:
+                self._scope_cache.pop(key, None)
             if msg.focus is not None:
                 self.eos.SetObjFocus(msg.focus - self.focus)
+                self.focus = msg.focus
             if msg.brightness is not None:
                 self.eos.SetBrightness(msg.brightness - self.brightness)
                 self.brightness = msg.brightness
             if msg.mag is not None:
-                mag_table = self.LOWMAG_TABLE if msg.mag_mode == "LM" else self.MAG_TABLE
-                assert msg.mag in mag_table
-                retry = 3
-                error = True
-                while retry and error:
-                    error = False
+                mag_values = self.LOWMAG_VALUES if msg.mag_mode == "LM" else self.MAG_VALUES
+                idx = bisect.bisect_left(mag_values, msg.mag)
+                assert idx < len(mag_values) and mag_values[idx] == msg.mag
+                for attempt in range(self.MAG_MODE_RETRIES):
                     try:
                         self.eos.SelectFunctionMode(self.MAG_MODES[msg.mag_mode])
-                    except TEM3.TEM3Error as e:
-                        error = True
-                        self._logger.warning("Timeout error when changing mag mode.")
-                        if retry == 1:
-                            raise e
-                    finally:
-                        retry -= 1
-                self.eos.SetSelector(mag_table[msg.mag])
+                        break
+                    except TEM3.TEM3Error:
+                        self._logger.warning("Timeout error when changing mag mode (attempt %d).", attempt + 1)
+                        if attempt == self.MAG_MODE_RETRIES - 1:
+                            raise
+                        # Keep the lock so a status update can't re-cache the old mode mid-change.
+                        time.sleep(self.MAG_MODE_BACKOFF * (1 << attempt))
+                self.eos.SetSelector(idx)
             if msg.spot_size is not None:
                 self.eos.SelectSpotSize(msg.spot_size)
             if msg.beam_offset is not None:
                 self.defl.SetCLA1(*msg.beam_offset)
             if msg.screen is not None:
                 self.defl.SetBeamBlank(msg.screen == "down")
+        # Settle without holding the lock so stage status keeps being published.
+        if (
+            msg.focus is not None
+            or msg.brightness is not None
+            or msg.beam_offset is not None
+            or msg.mag is not None
+        ):
             time.sleep(self.BEAM_MOVE_TIME)
-            if msg.focus is not None:
-                self.focus = msg.focus
-            if msg.brightness is not None:
-                self.brightness = msg.brightness
-            self.scope_status()
+        with self.scope_lock:
+            # Readings taken while the beam settled may have been cached, so read them again.
+            for key in stale:
+                self._scope_cache.pop(key, None)
+            # Let the run loop publish this alongside any stage status due on the same tick.
+            self.last_scope_status = float("-inf")
 
     def scope_status(self):
         with self.scope_lock:
-            self.connection.send(
-                "scope.status",
-                focus=self.focus,
-                aperture=None,
-                mag_mode="MAG" if self.eos.GetFunctionMode()[0] < 2 else "LOWMAG",
-                mag=self.eos.GetMagValue()[0],
-                tank_voltage=self.gun.GetHtCurrentValue()[0],
-                spot_size=self.eos.GetSpotSize(),
-                beam_offset=self.defl.GetCLA1(),
-                screen="down" if self.defl.GetBeamBlank() else "up",
-                brightness=self.brightness,
-            )
-            self.last_scope_status = time.time()
+            self._scope_status_locked()
+
+    def _cached(self, key, getter):
+        value = self._scope_cache.get(key)
+        if value is None:
+            value = self._scope_cache[key] = getter()
+        return value
+
+    def _scope_status_locked(self):
+        # Values can also be changed from the microscope console, so refresh periodically.
+        if time.monotonic() - self._scope_cache_time > self.SCOPE_CACHE_TIME:
+            self._scope_cache.clear()
+            self._scope_cache_time = time.monotonic()
+        self.connection.send(
+            "scope.status",
+            focus=self.focus,
+            aperture=None,
+            mag_mode="MAG" if self._cached("function_mode", self.eos.GetFunctionMode)[0] < 2 else "LOWMAG",
+            mag=self._cached("mag", self.eos.GetMagValue)[0],
+            tank_voltage=self._cached("tank_voltage", self.gun.GetHtCurrentValue)[0],
+            spot_size=self._cached("spot_size", self.eos.GetSpotSize),
+            beam_offset=self._cached("beam_offset", self.defl.GetCLA1),
+            screen="down" if self._cached("beam_blank", self.defl.GetBeamBlank) else "up",
+            brightness=self.brightness,
+        )
+        self.last_scope_status = time.monotonic()
 
-    def stage_status(self):
+    def stage_status(self, pose=None):
         with self.scope_lock:
-            x, y, z, tx, ty = self.stage.GetPos()
-            self.connection.send(
-                "stage.motion.status",
-                x=int(x),
-                y=int(y),
-                z=int(z),
-                in_motion=(in_motion:=self.in_motion),
-                calibrated=True,
-            )
-            self.connection.send(
-                "stage.rotation.status",
-                angle_x=tx * pi / 180,
-                angle_y=ty * pi / 180,
-                eucentric_height=0,
-                in_motion=in_motion,
-            )
+            self._stage_status_locked(pose if pose is not None else self._poll_pose())
+
+    def _stage_status_locked(self, pose):
+        x, y, z, tx, ty, in_motion = pose
+        self.connection.send(
+            "stage.motion.status",
+            x=int(x),
+            y=int(y),
+            z=int(z),
+            in_motion=in_motion,
+            calibrated=True,
+        )
+        self.connection.send(
+            "stage.rotation.status",
+            angle_x=tx,
+            angle_y=ty,
+            eucentric_height=0,
+            in_motion=in_motion,
+        )
+        if time.monotonic() - self.last_aperture_status > 1:
             self.connection.send(
                 "stage.aperture.status",
                 current_aperture=0,
                 calibrated=True,
             )
-            self.last_stage_status = time.time()
+            self.last_aperture_status = time.monotonic()
+        self.last_stage_status = time.monotonic()
 
     @property
     def in_motion(self):
         with self.scope_lock:
-            x, y, z, tx, ty = self.stage.GetPos()
-            tmp = ([
-                    abs(s - p) > self.trans_tol
-                    for s, p in zip((self.x, self.y, self.z), (x, y, z))
-                ]
-                + [abs(s - (p * pi / 180)) > self.rot_tol for s, p in zip((self.tx, self.ty), (tx, ty))])
-            return any(tmp)
+            return self._poll_pose()[-1]
+
+    def _poll_pose(self):
+        x, y, z, tx, ty = self.stage.GetPos()
+        pose = (x, y, z, tx * _RAD_PER_DEG, ty * _RAD_PER_DEG)
+        return pose + (self._check_motion(pose),)
+
+    def _check_motion(self, pose):
+        x, y, z, tx, ty = pose
+        t = self.trans_tol
+        r = self.rot_tol
+        return (
+            abs(self.x - x) > t
+            or abs(self.y - y) > t
+            or abs(self.z - z) > t
+            or abs(self.tx - tx) > r
+            or abs(self.ty - ty) > r
+        )
 
     def run_once(self):
-        period = 1 / 50 if (in_motion:=self.in_motion) or self.was_in_motion else 1
-        self.was_in_motion = in_motion
-        if time.time() - self.last_stage_status > period:
-            self.stage_status()
-        if time.time() - self.last_scope_status > 1:
-            self.scope_status()
+        with self.scope_lock:
+            pose = self._poll_pose()
+            in_motion = pose[-1]
+            period = 1 / 50 if in_motion or self.was_in_motion else 1
+            self.was_in_motion = in_motion
+            if time.monotonic() - self.last_stage_status > period:
+                self._stage_status_locked(pose)
+            if time.monotonic() - self.last_scope_status > 1:
+                self._scope_status_locked()
+        return period
 
     def run(self):
         while True:
+            timeout = 0.01
+            # Clear before the tick so a command arriving during or after it wakes the next wait.
+            self._wake.clear()
             try:
                 if not self.connection._connected:
                     time.sleep(0.1)
                     continue
-                self.run_once()
+                period = self.run_once()
+                next_deadline = min(self.last_stage_status + period, self.last_scope_status + 1)
+                timeout = max(0, next_deadline - time.monotonic())
             except Exception:
                 self._logger.warning("Error in run loop:", exc_info=True)
-            time.sleep(0.01)
+            self._wake.wait(timeout)
@@ -0,0 +1,83 @@
+import importlib
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+
+@pytest.fixture
+def service(mocker):
+    tem3 = mocker.MagicMock()
+    tem3.Stage3.return_value.GetPos.return_value = (0, 0, 0, 0, 0)
+    mocker.patch.dict(
+        sys.modules,
+        {
+            "PyJEM": mocker.MagicMock(TEM3=tem3),
+            "PyJEM.TEM3": tem3,
+            "pigeon": mocker.MagicMock(),
+        },
+    )
+    sys.modules.pop("pyjem_service", None)
+    pyjem_service = importlib.import_module("pyjem_service")
+    # Don't start the command worker, so tests can inspect and drain the queue themselves.
+    mocker.patch.object(pyjem_service, "Thread")
+    return pyjem_service.PyJEMService()
+
+
+def motion(x=None, y=None, z=None):
+    return SimpleNamespace(x=x, y=y, z=z)
+
+
+def rotation(angle_x=None, angle_y=None):
+    return SimpleNamespace(angle_x=angle_x, angle_y=angle_y)
+
+
+def drain(service):
+    while not service._cmd_q.empty():
+        apply, msg = service._cmd_q.get()
+        apply(msg)
+
+
+def test_motion_burst_is_conflated(service):
+    service.motion_callback(motion(x=1))
+    service.motion_callback(motion(y=2))
+    service.motion_callback(motion(x=3, z=4))
+
+    assert service._cmd_q.qsize() == 1
+
+    drain(service)
+
+    service.stage.SetX.assert_called_once_with(3)
+    service.stage.SetY.assert_called_once_with(2)
+    service.stage.SetZ.assert_called_once_with(4)
+    assert (service.x, service.y, service.z) == (3, 2, 4)
+
+
+def test_motion_after_drain_is_queued_again(service):
+    service.motion_callback(motion(x=1))
+    drain(service)
+    service.motion_callback(motion(x=2))
+
+    assert service._cmd_q.qsize() == 1
+
+    drain(service)
+
+    assert [call.args for call in service.stage.SetX.call_args_list] == [(1,), (2,)]
+
+
+def test_motion_is_not_reordered_past_other_commands(service):
+    service.motion_callback(motion(x=1))
+    service.rotation_callback(rotation(angle_x=0.1))
+    service.motion_callback(motion(x=2))
+
+    assert service._cmd_q.qsize() == 3
+
+    drain(service)
+
+    calls = [
+        name
+        for name, args, _ in service.stage.mock_calls
+        if name in ("SetX", "SetTiltXAngle")
+    ]
+    assert calls == ["SetX", "SetTiltXAngle", "SetX"]
+    assert [call.args for call in service.stage.SetX.call_args_list] == [(1,), (2,)]